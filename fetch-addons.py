@@ -1,13 +1,15 @@
 #!/usr/bin/env nix-shell
-#!nix-shell -i python -p python3 python3Packages.requests
+#!nix-shell -i python -p python3 python3Packages.httpx python3Packages.h2 python3Packages.orjson
 """
 This script fetches Firefox extension data from the Mozilla Add-ons API.
 It accepts optional command-line arguments:
   - --pages: number of pages to fetch. If not provided, all pages are fetched.
   - --min-users: minimum number of users. If not provided, no users__gt parameter is added.
   - --verbose: enable verbose debug output (to stderr)
-  - --parallel: number of parallel processes (default: 4)
-  - --page-size: number of results per page (default: 50)
+  - --parallel: number of pages fetched in parallel (default: 5 per CPU core).
+                Fetching is network-bound, so raise it for large page counts and lower it
+                only if the API starts rate-limiting.
+  - --page-size: number of results per page, 1..50 (default: 50)
 
 The API endpoint used is:
   https://addons.mozilla.org/api/v5/addons/search/?lang=en-US&app=firefox&sort=users&users__gt=100&page_size=50&page=1
@@ -29,7 +31,7 @@ are processed.
 
 Mapping each addon result uses this schema:
 {
-  pname   = slug;                # if slug is a dict, its value for key equal to default_locale is used
+  pname   = slug;
   version = current_version.version;
   url     = current_version.file.url;
   hash    = current_version.file.hash;  # Converted from a format like "sha256:..." to SRI format for NixOS.
@@ -50,63 +52,149 @@ Mapping each addon result uses this schema:
     promotedCategory    = promoted.category;
   };
 }
-Non‑meta fields are required (the script crashes if any is missing). Meta fields are optional.
+Non‑meta fields are required (the script crashes if any is missing). Meta fields are optional
+(meta itself is always written, possibly empty).
 """
 
+import os
 import sys
-import json
 import argparse
+import asyncio
 import logging
-import requests
-import base64
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-def is_hex_string(s):
-    """Return True if string s consists solely of hexadecimal digits."""
-    hex_digits = set("0123456789abcdefABCDEF")
-    return all(c in hex_digits for c in s)
-
-def convert_to_sri(hash_str, verbose, addon_guid):
+import math
+import heapq
+import httpx
+import orjson
+from binascii import a2b_hex, b2a_base64
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from operator import attrgetter
+
+# Page fetches are network-bound, so use several of them per CPU core.
+DEFAULT_PARALLEL = (os.cpu_count() or 4) * 5
+
+# The API serves at most this many results per page, whatever page_size is requested.
+MAX_PAGE_SIZE = 50
+
+# Transient failures of a page fetch are retried with exponential backoff.
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+# Like urllib3, the server's Retry-After is only honoured for these statuses,
+# and never waited on longer than MAX_RETRY_DELAY seconds.
+RETRY_AFTER_STATUSES = frozenset((429, 503))
+MAX_RETRY_DELAY = 60
+
+# Optional meta fields copied as is: (meta key, source object, source key).
+# Source objects are built in process_result; the order here is the key order of the output.
+META_FIELDS = (
+    ("license", "license", "slug"),
+    ("permissions", "file", "permissions"),
+    ("hostPermissions", "file", "host_permissions"),
+    ("optionalPermissions", "file", "optional_permissions"),
+    ("requiresPayment", "result", "requires_payment"),
+    ("compatibility", "compatibility", "firefox"),
+    ("categories", "result", "categories"),
+    ("tags", "result", "tags"),
+    ("hasEula", "result", "has_eula"),
+    ("hasPrivacyPolicy", "result", "has_privacy_policy"),
+    ("promotedCategory", "promoted", "category"),
+)
+
+@dataclass(slots=True)
+class Addon:
+    """A mapped addon; serialized by orjson in field order."""
+    pname: str
+    version: str
+    url: str
+    hash: str
+    addonId: str
+    meta: dict = field(default_factory=dict)
+
+# Output order of addons; a C-level getter instead of a Python lambda per comparison.
+PNAME_KEY = attrgetter("pname")
+
+SRI_ALGOS = frozenset(("sha256", "sha512"))
+
+def is_sri(hash_str):
+    """Return True if hash_str is already in SRI format ("sha256-..." or "sha512-...")."""
+    return hash_str[6:7] == "-" and hash_str[:6] in SRI_ALGOS
+
+@lru_cache(maxsize=16384)
+def convert_to_sri(hash_str):
     """
     Convert a hash string into SRI format for NixOS.
     If provided as "sha256:<hex>" (or "sha512:<hex>"), it converts the hex part
     to base64 and returns a string like "sha256-<base64>".
     If already in SRI format or not valid hex, returns the original.
     """
-    if hash_str.startswith("sha256-") or hash_str.startswith("sha512-"):
-        if verbose:
-            logging.debug("Addon %s: hash already in SRI format: %s", addon_guid, hash_str)
+    if is_sri(hash_str):
         return hash_str
 
-    if hash_str.startswith("sha256:"):
-        algo = "sha256"
-        hex_part = hash_str[len("sha256:"):]
-    elif hash_str.startswith("sha512:"):
-        algo = "sha512"
-        hex_part = hash_str[len("sha512:"):]
-    else:
-        if is_hex_string(hash_str):
-            algo = "sha256"
-            hex_part = hash_str
-        else:
-            if verbose:
-                logging.debug("Addon %s: hash is not a valid hex string, returning original: %s", addon_guid, hash_str)
-            return hash_str
+    algo, sep, hex_part = hash_str.partition(":")
+    if not sep:
+        # A bare hex digest is assumed to be sha256.
+        algo, hex_part = "sha256", hash_str
+    elif algo not in SRI_ALGOS:
+        return hash_str
 
-    if not is_hex_string(hex_part):
-        if verbose:
-            logging.debug("Addon %s: hash part is not valid hex, returning original: %s", addon_guid, hash_str)
+    # a2b_hex validates the hex digits while decoding them.
+    try:
+        digest = a2b_hex(hex_part)
+    except ValueError:
+        return hash_str
+    if not digest:
         return hash_str
 
-    hash_bytes = bytes.fromhex(hex_part)
-    sri_hash = f"{algo}-" + base64.b64encode(hash_bytes).decode("utf-8")
-    return sri_hash
+    return algo + "-" + b2a_base64(digest, newline=False).decode("ascii")
+
+def retry_after(response):
+    """
+    Return the delay in seconds requested by the response's Retry-After header
+    (either a number of seconds or an HTTP date), capped at MAX_RETRY_DELAY.
+    Returns 0 if the header is missing or invalid, or if the status is not one
+    of RETRY_AFTER_STATUSES.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None or response.status_code not in RETRY_AFTER_STATUSES:
+        return 0
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return 0
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        delay = (when - datetime.now(timezone.utc)).total_seconds()
+    if not math.isfinite(delay):
+        return 0
+    return min(max(0.0, delay), MAX_RETRY_DELAY)
+
+def make_client(pool_size):
+    """
+    Create an HTTP client shared by all page fetches.
+    Requests are multiplexed over a single HTTP/2 connection to the API host;
+    if the server only speaks HTTP/1.1, up to pool_size keep-alive connections
+    are used instead.
+    """
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    # No pool timeout: waiting for a free connection in the pool is expected.
+    timeout = httpx.Timeout(30, connect=5, pool=None)
+    # Follow redirects like requests and aiohttp did before.
+    return httpx.AsyncClient(http2=True, limits=limits, timeout=timeout, follow_redirects=True)
 
-def fetch_page(page, page_size, min_users, verbose):
+async def fetch_page(client, page, page_size, min_users):
     """
     Fetch a page from the Mozilla Add-ons API using the provided parameters.
     If min_users is None, the "users__gt" parameter is omitted.
-    Any error during fetching will raise an exception.
+    Transient errors (connection failures, 429 and 5xx responses) are retried,
+    any other error during fetching will raise an exception.
+    Results which are not public are dropped from the returned page.
     """
     base_url = "https://addons.mozilla.org/api/v5/addons/search/"
     params = {
@@ -119,27 +207,90 @@ def fetch_page(page, page_size, min_users, verbose):
     if min_users is not None:
         params["users__gt"] = min_users
 
-    if verbose:
-        logging.debug("Fetching page %d with parameters: %s", page, params)
-    response = requests.get(base_url, params=params)
-    response.raise_for_status()
-    data = response.json()
-    if verbose:
-        logging.debug("Page %d fetched successfully with %d results", page, len(data.get("results", [])))
+    logging.debug("Fetching page %d with parameters: %s", page, params)
+    for attempt in range(MAX_RETRIES + 1):
+        last_attempt = attempt == MAX_RETRIES
+        server_delay = 0
+        try:
+            response = await client.get(base_url, params=params)
+            if last_attempt or response.status_code not in RETRY_STATUSES:
+                response.raise_for_status()
+                # Parse the (already decompressed) body bytes, skipping the str decode.
+                data = orjson.loads(response.content)
+                break
+            reason = f"HTTP {response.status_code}"
+            server_delay = retry_after(response)
+        except httpx.TransportError as e:
+            if last_attempt:
+                raise
+            reason = repr(e)
+        delay = max(RETRY_BACKOFF * 2 ** attempt, server_delay)
+        logging.debug("Page %d fetch failed (%s), retrying in %.1fs", page, reason, delay)
+        await asyncio.sleep(delay)
+    logging.debug("Page %d fetched successfully with %d results", page, len(data.get("results", [])))
+    # The page count is computed from the requested page size, so a page served
+    # with another size would silently skip results.
+    if data["page_size"] != page_size:
+        raise Exception(f"Page {page} served with page_size {data['page_size']} instead of {page_size}")
+
+    # Only public addons with a public current file are processed.
+    results = data.get("results", [])
+    data["results"] = [
+        result for result in results
+        if result["status"] == "public" and result["current_version"]["file"]["status"] == "public"
+    ]
+    if len(data["results"]) != len(results):
+        logging.debug("Page %d: skipped %d non-public results", page, len(results) - len(data["results"]))
     return data
 
-def process_result(result, verbose):
+async def fetch_pages(args, process_pool):
     """
-    Process a single addon result.
+    Fetch the requested pages concurrently on a single event loop.
+    A one-result probe of page 1 is fetched first to learn how many pages are
+    available, then all pages are fetched in parallel.
+    Every page is handed to process_pool for mapping as soon as it arrives,
+    so the CPU-bound mapping overlaps the remaining fetches.
+    Returns the mapped results of every page.
+    """
+    loop = asyncio.get_running_loop()
+    # HTTP/2 streams are not limited by the connection pool, so cap in-flight requests here.
+    in_flight = asyncio.Semaphore(args.parallel)
+
+    async def fetch_and_process(client, page):
+        async with in_flight:
+            data = await fetch_page(client, page, args.page_size, args.min_users)
+        return await loop.run_in_executor(process_pool, process_page_results, data.get("results", []))
+
+    async with make_client(args.parallel) as client:
+        # With page_size=1 the page count is the number of available results.
+        probe = await fetch_page(client, 1, 1, args.min_users)
+        total_pages = math.ceil(probe.get("page_count", 1) / args.page_size)
+        logging.debug("API reports %d pages available.", total_pages)
+
+        # Determine how many pages to fetch.
+        if args.pages is not None:
+            requested_pages = min(args.pages, total_pages)
+        else:
+            requested_pages = total_pages
+
+        logging.debug("Fetching %d pages in total.", requested_pages)
+
+        return await asyncio.gather(*[
+            fetch_and_process(client, page)
+            for page in range(1, requested_pages + 1)
+        ])
+
+def process_result(result):
+    """
+    Process a single addon result (already filtered to public ones by fetch_page).
     All required (non‑meta) fields are extracted (crashing if missing).
     Meta fields are optional and are added only if present.
-    Localization is determined by the addon's 'default_locale' field.
+    Returns the mapped Addon.
+    Localization of translated fields is determined by the addon's
+    'default_locale' field (slug is never translated).
     """
-    # Check required statuses.
-    if result["status"] != "public":
-        raise Exception(f"Addon {result.get('guid')} does not have required status 'public'.")
-    if result["current_version"]["file"]["status"] != "public":
-        raise Exception(f"Addon {result.get('guid')} current_version file does not have status 'public'.")
+    current_version = result["current_version"]
+    file_obj = current_version["file"]
 
     # Extract required field: default_locale.
     try:
@@ -149,27 +300,20 @@ def process_result(result, verbose):
 
     # Extract required fields.
     try:
-        slug = result["slug"]
-        if isinstance(slug, dict):
-            pname = slug[default_locale]
-        else:
-            pname = slug
-        version = result["current_version"]["version"]
-        url = result["current_version"]["file"]["url"]
-        hash_str = result["current_version"]["file"]["hash"]
-        converted_hash = convert_to_sri(hash_str, verbose, result["guid"])
+        pname = result["slug"]
+        version = current_version["version"]
+        url = file_obj["url"]
+        hash_str = file_obj["hash"]
         addonId = result["guid"]
+        converted_hash = convert_to_sri(hash_str)
+        if converted_hash == hash_str:
+            if is_sri(hash_str):
+                logging.debug("Addon %s: hash already in SRI format: %s", addonId, hash_str)
+            else:
+                logging.debug("Addon %s: hash has an unsupported algorithm or is not valid hex, returning original: %s", addonId, hash_str)
     except KeyError as e:
         raise Exception(f"Missing required field: {e}")
 
-    mapped = {
-        "pname": pname,
-        "version": version,
-        "url": url,
-        "hash": converted_hash,
-        "addonId": addonId,
-    }
-
     # Build meta dictionary from optional fields.
     meta = {}
 
@@ -195,51 +339,70 @@ def process_result(result, verbose):
         if desc is not None:
             meta["description"] = desc
 
-    # license: from current_version.license.slug
-    license_obj = result.get("current_version", {}).get("license")
-    if license_obj and "slug" in license_obj:
-        meta["license"] = license_obj["slug"]
-
-    # permissions, hostPermissions, optionalPermissions from current_version.file.
-    file_obj = result.get("current_version", {}).get("file", {})
-    if "permissions" in file_obj:
-        meta["permissions"] = file_obj["permissions"]
-    if "host_permissions" in file_obj:
-        meta["hostPermissions"] = file_obj["host_permissions"]
-    if "optional_permissions" in file_obj:
-        meta["optionalPermissions"] = file_obj["optional_permissions"]
-
-    # requiresPayment from result.
-    if "requires_payment" in result:
-        meta["requiresPayment"] = result["requires_payment"]
-
-    # compatibility: from compatibility.firefox.
-    compatibility_obj = result.get("compatibility")
-    if compatibility_obj and "firefox" in compatibility_obj:
-        meta["compatibility"] = compatibility_obj["firefox"]
-
-    # categories and tags.
-    if "categories" in result:
-        meta["categories"] = result["categories"]
-    if "tags" in result:
-        meta["tags"] = result["tags"]
-
-    # hasEula and hasPrivacyPolicy.
-    if "has_eula" in result:
-        meta["hasEula"] = result["has_eula"]
-    if "has_privacy_policy" in result:
-        meta["hasPrivacyPolicy"] = result["has_privacy_policy"]
-
-    # promotedCategory: from promoted.category.
-    promoted_obj = result.get("promoted")
-    if promoted_obj and "category" in promoted_obj:
-        meta["promotedCategory"] = promoted_obj["category"]
-
-    if meta:
-        mapped["meta"] = meta
+    # The rest of meta is copied as is from the source objects of META_FIELDS.
+    sources = {
+        "result": result,
+        "license": current_version.get("license") or {},
+        "file": file_obj,
+        "compatibility": result.get("compatibility") or {},
+        "promoted": result.get("promoted") or {},
+    }
+    meta.update({
+        meta_key: sources[source][key]
+        for meta_key, source, key in META_FIELDS
+        if key in sources[source]
+    })
+
+    return Addon(pname, version, url, converted_hash, addonId, meta)
 
+def process_page_results(results):
+    """
+    Process all addon results of a single page and sort them by 'pname'.
+    Runs in a worker process, so the mapping of different pages is spread
+    across CPU cores.
+    """
+    mapped = [process_result(result) for result in results]
+    mapped.sort(key=PNAME_KEY)
     return mapped
 
+def write_json_list(out, items):
+    """
+    Write items to the binary stream out as a JSON array indented by 2 spaces
+    and terminated by a newline (like orjson's OPT_INDENT_2 | OPT_APPEND_NEWLINE),
+    encoding one item at a time instead of the whole list at once.
+    """
+    separator = b"[\n  "
+    for item in items:
+        out.write(separator + orjson.dumps(item, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n  "))
+        separator = b",\n  "
+    out.write(b"[]\n" if separator == b"[\n  " else b"\n]\n")
+
+def setup_logging(verbose):
+    """Configure debug output to stderr (also used to initialize worker processes)."""
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG, stream=sys.stderr,
+                            format="%(levelname)s: %(message)s")
+    else:
+        logging.basicConfig(level=logging.WARNING, stream=sys.stderr,
+                            format="%(levelname)s: %(message)s")
+    # Keep the HTTP client's own debug output out of the verbose log.
+    for name in ("httpx", "httpcore", "h2", "hpack"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+def page_size_arg(value):
+    """Parse --page-size, which the API silently caps at MAX_PAGE_SIZE."""
+    page_size = int(value)
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise argparse.ArgumentTypeError(f"must be between 1 and {MAX_PAGE_SIZE}, got {page_size}")
+    return page_size
+
+def parallel_arg(value):
+    """Parse --parallel; with no fetch allowed in flight the run would hang."""
+    parallel = int(value)
+    if parallel < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {parallel}")
+    return parallel
+
 def main():
     parser = argparse.ArgumentParser(
         description="Fetch Firefox extension data via the Mozilla Add-ons API."
@@ -249,54 +412,22 @@ def main():
     parser.add_argument("--min-users", type=int, default=None,
                         help="Minimum number of users. If not provided, no users__gt parameter is added.")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose debug output")
-    parser.add_argument("--parallel", type=int, default=4, help="Number of parallel processes (default: 4)")
-    parser.add_argument("--page-size", type=int, default=50, help="Number of results per page (default: 50)")
+    parser.add_argument("--parallel", type=parallel_arg, default=DEFAULT_PARALLEL,
+                        help=f"Number of pages fetched in parallel (default: {DEFAULT_PARALLEL})")
+    parser.add_argument("--page-size", type=page_size_arg, default=MAX_PAGE_SIZE,
+                        help=f"Number of results per page, 1..{MAX_PAGE_SIZE} (default: {MAX_PAGE_SIZE})")
     args = parser.parse_args()
 
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG, stream=sys.stderr,
-                            format="%(levelname)s: %(message)s")
-    else:
-        logging.basicConfig(level=logging.WARNING, stream=sys.stderr,
-                            format="%(levelname)s: %(message)s")
-
-    # Fetch page 1 synchronously.
-    first_page = fetch_page(1, args.page_size, args.min_users, args.verbose)
-    total_pages = first_page.get("page_count", 1)
-    if args.verbose:
-        logging.debug("API reports %d pages available.", total_pages)
-
-    # Determine how many pages to fetch.
-    if args.pages is not None:
-        requested_pages = min(args.pages, total_pages)
-    else:
-        requested_pages = total_pages
+    setup_logging(args.verbose)
 
-    if args.verbose:
-        logging.debug("Fetching %d pages in total.", requested_pages)
+    # Map the fetched results in worker processes, since it is CPU-bound.
+    with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                             initializer=setup_logging, initargs=(args.verbose,)) as process_pool:
+        mapped_pages = asyncio.run(fetch_pages(args, process_pool))
 
-    results_list = []
-    # Process results from page 1.
-    for addon in first_page.get("results", []):
-        mapped = process_result(addon, args.verbose)
-        results_list.append(mapped)
-
-    # If more pages are needed, fetch them concurrently.
-    if requested_pages > 1:
-        with ThreadPoolExecutor(max_workers=args.parallel) as executor:
-            future_to_page = {
-                executor.submit(fetch_page, page, args.page_size, args.min_users, args.verbose): page
-                for page in range(2, requested_pages + 1)
-            }
-            for future in as_completed(future_to_page):
-                data = future.result()  # raises exception if fetch_page fails
-                for addon in data.get("results", []):
-                    mapped = process_result(addon, args.verbose)
-                    results_list.append(mapped)
-
-    # Sort the results by the 'pname' field.
-    sorted_results = sorted(results_list, key=lambda x: x["pname"])
-    json.dump(sorted_results, sys.stdout, indent=2)
+    # Merge the per-page sorted results by the 'pname' field.
+    sorted_results = heapq.merge(*mapped_pages, key=PNAME_KEY)
+    write_json_list(sys.stdout.buffer, sorted_results)
     sys.stdout.flush()
 
 if __name__ == "__main__":